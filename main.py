@@ -1,77 +1,205 @@
 import os
 import sys
 import re
+import io
 import requests
+import shutil
+import subprocess
 import tempfile
 import concurrent.futures
 import time
-import threading
+import urllib3
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
+from urllib3.util.retry import Retry
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+CHUNK_SIZE = 64 * 1024
+# Segment downloads are latency bound, so run more of them in flight than there are cores
+MAX_WORKERS = 16
+# Segments allowed in memory at once (downloading or waiting for their turn to be written)
+MAX_BUFFERED = MAX_WORKERS * 2
+# Segments handed to a single writev() call, well below IOV_MAX on every platform that has it
+WRITEV_BATCH = 64
+# Kernel buffer requested for the pipe into ffmpeg, the default unprivileged maximum on Linux
+PIPE_SIZE = 1024 * 1024
+# Minimum seconds between progress bar redraws
+PROGRESS_INTERVAL = 0.1
+
+RESOLUTION_RE = re.compile(r'RESOLUTION=(\d+x\d+)')
+URI_RE = re.compile(r'URI="([^"]+)"')
+# Relative references that urljoin resolves to exactly base directory + reference: no scheme, no
+# absolute path, no dot segments, no "//" or ";" params in the path, no empty query or fragment,
+# and no spaces or control characters (urlsplit strips some of those)
+PLAIN_SEGMENT_RE = re.compile(r'(?![/.])(?!.*//)(?!.*/\.)[^:;?#\x00-\x20\x7f]+(?:\?[^#\x00-\x20\x7f]+)?(?:#[^\x00-\x20\x7f]+)?')
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "Origin": "https://player.videasy.net",
+    "Referer": "https://player.videasy.net/"
+}
+
+def create_session():
+    """
+    Session whose connection pool holds one keep-alive connection per worker and
+    which retries failed connects and transient HTTP errors with exponential backoff.
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=MAX_WORKERS, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 def download_text(session, url):
     r = session.get(url)
     r.raise_for_status()
     return r.text
 
-def download_binary_with_retry(session, url, max_retries=3, backoff=1):
+def download_binary_with_retry(session, url, sink, max_retries=3, backoff=1):
+    """
+    Stream the body of url into sink (a writable, seekable file object) in CHUNK_SIZE reads.
+    Connect errors and bad statuses are retried by the session's adapter, this loop
+    only covers a body that breaks off mid-transfer.
+    """
     for attempt in range(1, max_retries + 1):
-        try:
-            r = session.get(url, stream=True, timeout=10)
+        # Segments are already compressed video, ask for the raw bytes so nothing has to be decoded
+        with session.get(url, stream=True, timeout=10, headers={"Accept-Encoding": "identity"}) as r:
             r.raise_for_status()
-            return r.content
-        except (requests.exceptions.RequestException, requests.exceptions.ChunkedEncodingError) as e:
-            print(f"\n[!] Error while downloading {url} (Attempt {attempt}/{max_retries}): {e}")
-            if attempt == max_retries:
-                raise
-            time.sleep(backoff * attempt)  # exponential backoff
-
-def is_master_playlist(m3u8_content):
-    return "#EXT-X-STREAM-INF" in m3u8_content
-
-def list_playlists(m3u8_content, base_url):
+            # Copy straight from the urllib3 response instead of going through iter_content's generator
+            r.raw.decode_content = True
+            try:
+                shutil.copyfileobj(r.raw, sink, CHUNK_SIZE)
+                return sink
+            except urllib3.exceptions.HTTPError as e:
+                print(f"\n[!] Error while downloading {url} (Attempt {attempt}/{max_retries}): {e}")
+                if attempt == max_retries:
+                    raise
+                # Drop whatever part of the body arrived before the failure
+                sink.seek(0)
+                sink.truncate()
+        time.sleep(backoff * attempt)  # exponential backoff
+
+def parse_m3u8(m3u8_content, base_url):
     """
-    Return a list of tuples: (resolution_str, playlist_url)
+    Walk the playlist once and return a dict with:
+      is_master: True if it lists variant streams
+      playlists: list of tuples (resolution_str, playlist_url)
+      subtitles: list of subtitle playlist URLs
+      segments:  list of media segment URLs
     """
-    lines = m3u8_content.strip().splitlines()
+    lines = m3u8_content.splitlines()
+    # Directory of base_url, plain relative segment names can simply be appended to it
+    base_dir = urljoin(base_url, ".")
+    is_master = False
     playlists = []
-    for i, line in enumerate(lines):
+    subtitles = []
+    segments = []
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
         if line.startswith("#EXT-X-STREAM-INF"):
-            # Try to find RESOLUTION
-            m = re.search(r'RESOLUTION=(\d+x\d+)', line)
-            res = m.group(1) if m else "Unknown resolution"
-            playlist_url = urljoin(base_url, lines[i+1].strip())
-            playlists.append((res, playlist_url))
-    return playlists
+            is_master = True
+            # Try to find RESOLUTION, audio-only variants don't have one
+            res = "Unknown resolution"
+            if "RESOLUTION=" in line:
+                m = RESOLUTION_RE.search(line)
+                if m:
+                    res = m.group(1)
+            # The variant URI is on the line following the tag
+            if i + 1 < len(lines):
+                playlists.append((res, urljoin(base_url, lines[i+1].strip())))
+            i += 2
+            continue
+        if line.startswith("#EXT-X-MEDIA") and "TYPE=SUBTITLES" in line:
+            m = URI_RE.search(line)
+            if m:
+                subtitles.append(urljoin(base_url, m.group(1)))
+        elif line and not line.startswith("#"):
+            # Anything urljoin would rewrite still goes through it
+            if PLAIN_SEGMENT_RE.fullmatch(line):
+                segments.append(base_dir + line)
+            else:
+                segments.append(urljoin(base_url, line))
+        i += 1
+    return {"is_master": is_master, "playlists": playlists, "subtitles": subtitles, "segments": segments}
 
 def pick_playlist_by_index(playlists, index):
     if index < 1 or index > len(playlists):
         raise ValueError("Invalid playlist selection")
     return playlists[index-1][1]
 
-def parse_segments(m3u8_content, base_url):
-    return [urljoin(base_url, line.strip()) for line in m3u8_content.splitlines() if not line.startswith("#") and line.strip()]
+def enlarge_pipe(fd, size=PIPE_SIZE):
+    """
+    Grow the kernel buffer of a pipe so each write hands more data to the reader at once.
+    Only Linux supports resizing pipes, elsewhere this does nothing.
+    """
+    if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except OSError:
+        pass  # size is above /proc/sys/fs/pipe-max-size, keep the default
+
+def write_buffers(fd, buffers):
+    """
+    Write every buffer to fd in order, handing as many as possible to the kernel
+    per writev() call. Falls back to one write() per buffer where writev is missing (Windows).
+    """
+    views = [memoryview(buf) for buf in buffers if len(buf)]
+    while views:
+        if hasattr(os, "writev"):
+            written = os.writev(fd, views[:WRITEV_BATCH])
+        else:
+            written = os.write(fd, views[0])
+        # Drop the buffers that were written completely, keep the unwritten tail of a partial one
+        while written:
+            if written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][written:]
+                written = 0
+
+def choose_playlist(playlists):
+    """
+    Ask the user for one of the (resolution_str, playlist_url) tuples and return it.
+    """
+    print("\nAvailable video resolutions:")
+    for i, (res, _) in enumerate(playlists, 1):
+        print(f"  {i}. {res}")
+    while True:
+        choice = input(f"Select resolution [1-{len(playlists)}]: ").strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(playlists):
+            return playlists[int(choice) - 1]
+        print("Invalid input, please enter a valid number.")
+
+def resolve_playlist(session, m3u8_url):
+    """
+    Download m3u8_url and, if it is a master playlist, let the user pick a resolution
+    and download that variant. Return (playlist_url, segment_urls, subtitle_urls).
+    """
+    master_content = download_text(session, m3u8_url)
+    # Subtitles are only listed in the master playlist
+    master = parse_m3u8(master_content, m3u8_url)
+
+    # A media playlist was already fully parsed above, its segments can be used as they are
+    if not master["is_master"]:
+        print("[+] No master playlist detected, using the provided URL.")
+        return m3u8_url, master["segments"], master["subtitles"]
+    if not master["playlists"]:
+        print("[!] No playlists found in master playlist, using original URL.")
+        return m3u8_url, master["segments"], master["subtitles"]
 
-def find_subtitles(m3u8_content, base_url):
-    subs = []
-    for line in m3u8_content.splitlines():
-        if line.startswith("#EXT-X-MEDIA") and "TYPE=SUBTITLES" in line:
-            m = re.search(r'URI="([^"]+)"', line)
-            if m:
-                subs.append(urljoin(base_url, m.group(1)))
-    return subs
-
-def vtt_to_srt(vtt_text):
-    srt = []
-    counter = 1
-    for block in vtt_text.replace("\r", "").split("\n\n"):
-        lines = block.strip().splitlines()
-        if not lines:
-            continue
-        if "-->" in lines[0]:  # timestamp without counter
-            lines.insert(0, str(counter))
-            counter += 1
-        srt.append("\n".join(lines))
-    return "\n\n".join(srt).replace("WEBVTT\n", "").strip()
+    res, selected_playlist_url = choose_playlist(master["playlists"])
+    print(f"\n[+] Selected playlist: {res} - {selected_playlist_url}\n")
+    playlist_content = download_text(session, selected_playlist_url)
+    return selected_playlist_url, parse_m3u8(playlist_content, selected_playlist_url)["segments"], master["subtitles"]
 
 def print_progress_bar(current, total, bar_length=40):
     fraction = current / total
@@ -79,87 +207,123 @@ def print_progress_bar(current, total, bar_length=40):
     bar = "█" * filled_length + '-' * (bar_length - filled_length)
     print(f"\rProgress: |{bar}| {current}/{total} segments", end='', flush=True)
 
-def main(m3u8_url, output_file="output.mp4"):
-    headers = {
-        "User-Agent": "Mozilla/5.0",
-        "Origin": "https://player.videasy.net",
-        "Referer": "https://player.videasy.net/"
-    }
-    session = requests.Session()
-    session.headers.update(headers)
+def main(m3u8_url, output_file="output.mp4", *, prefetched_segments=None, prefetched_subtitle_urls=None):
+    session = create_session()
 
-    print(f"[+] Downloading master playlist: {m3u8_url}")
-    master_content = download_text(session, m3u8_url)
-
-    # Find subtitles URLs from master playlist
-    subtitle_urls = find_subtitles(master_content, m3u8_url)
-
-    # Check if master playlist
-    if is_master_playlist(master_content):
-        playlists = list_playlists(master_content, m3u8_url)
-        if not playlists:
-            print("[!] No playlists found in master playlist.")
-            return
-        print("\nAvailable video resolutions:")
-        for i, (res, _) in enumerate(playlists, 1):
-            print(f"  {i}. {res}")
-        while True:
-            choice = input(f"Select resolution [1-{len(playlists)}]: ").strip()
-            if choice.isdigit() and 1 <= int(choice) <= len(playlists):
-                chosen_index = int(choice)
-                break
-            print("Invalid input, please enter a valid number.")
-        selected_playlist_url = playlists[chosen_index - 1][1]
-        print(f"\n[+] Selected playlist: {playlists[chosen_index - 1][0]} - {selected_playlist_url}\n")
-        playlist_content = download_text(session, selected_playlist_url)
+    if prefetched_segments is not None:
+        # get_user_input already fetched the media playlist and picked the resolution
+        segments = prefetched_segments
+        subtitle_urls = prefetched_subtitle_urls or []
     else:
-        # No master playlist, just use given url content
-        playlist_content = master_content
+        print(f"[+] Downloading master playlist: {m3u8_url}")
+        _, segments, subtitle_urls = resolve_playlist(session, m3u8_url)
 
-    segments = parse_segments(playlist_content, m3u8_url if not is_master_playlist(master_content) else selected_playlist_url)
     if not segments:
         raise RuntimeError("No segments found in playlist.")
-    print(f"[+] Found {len(segments)} segments. Downloading in parallel...")
-
-    temp_ts = tempfile.NamedTemporaryFile(delete=False, suffix=".ts").name
-
-    with open(temp_ts, "wb") as f:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-            # To track progress safely across threads, use a thread-safe counter
-            progress = {'count': 0}
-            lock = threading.Lock()
-
-            def download_and_track(url):
-                data = download_binary_with_retry(session, url)
-                with lock:
-                    progress['count'] += 1
-                    print_progress_bar(progress['count'], len(segments))
-                return data
 
-            for data in executor.map(download_and_track, segments):
-                f.write(data)
-
-    print("\n[+] All segments downloaded.")
+    print(f"[+] Found {len(segments)} segments. Downloading in parallel and muxing with ffmpeg...")
 
+    # One in-memory sink per segment, keyed by its index in the playlist
+    futures = {}
+    done = {}
+    next_submit = 0
+    next_write = 0
+    last_print = 0.0
     sub_file = None
-    if subtitle_urls:
-        print(f"[+] Downloading subtitles from: {subtitle_urls[0]}")
-        vtt_text = download_text(session, subtitle_urls[0])
-        srt_text = vtt_to_srt(vtt_text)
-        sub_file = tempfile.NamedTemporaryFile(delete=False, suffix=".srt").name
-        with open(sub_file, "w", encoding="utf-8") as sf:
-            sf.write(srt_text)
-
-    print("[+] Muxing video (and subtitles if present) with ffmpeg...")
-
-    if sub_file:
-        os.system(f'ffmpeg -y -i "{temp_ts}" -i "{sub_file}" -c copy -c:s mov_text "{output_file}"')
-    else:
-        os.system(f'ffmpeg -y -i "{temp_ts}" -c copy "{output_file}"')
+    tmp_output = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        def submit_segments():
+            nonlocal next_submit
+            # Keep at most MAX_BUFFERED segments downloading or waiting to be written
+            while next_submit < len(segments) and next_submit - next_write < MAX_BUFFERED:
+                future = executor.submit(download_binary_with_retry, session, segments[next_submit], io.BytesIO())
+                futures[future] = next_submit
+                next_submit += 1
+
+        # Subtitles download alongside the first segments
+        sub_future = None
+        if subtitle_urls:
+            print(f"[+] Downloading subtitles from: {subtitle_urls[0]}")
+            sub_future = executor.submit(download_text, session, subtitle_urls[0])
+        submit_segments()
 
-    os.remove(temp_ts)
-    if sub_file:
-        os.remove(sub_file)
+        try:
+            # ffmpeg needs every input when it starts, so only the subtitles are waited for here
+            if sub_future:
+                vtt_text = sub_future.result()
+                # ffmpeg reads WebVTT natively, no need to convert to SRT first
+                sub_file = tempfile.NamedTemporaryFile(delete=False, suffix=".vtt").name
+                with open(sub_file, "w", encoding="utf-8") as sf:
+                    sf.write(vtt_text)
+
+            # ffmpeg writes to a temporary file next to output_file, which only replaces
+            # output_file once the mux succeeded, so a failed run never touches an existing file
+            fd, tmp_output = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_file)), suffix=os.path.splitext(output_file)[1])
+            os.close(fd)
+            # mkstemp creates the file 0600, give the result the permissions a normal new file would get
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_output, 0o666 & ~umask)
+
+            # ffmpeg reads the transport stream from stdin and remuxes while the remaining segments download
+            cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", "pipe:0"]
+            if sub_file:
+                cmd += ["-i", sub_file, "-c", "copy", "-c:s", "mov_text"]
+            else:
+                cmd += ["-c", "copy"]
+            cmd.append(tmp_output)
+
+            # Unbuffered stdin, segments go to the pipe with write_buffers rather than through a Python buffer
+            with subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=0) as ffmpeg:
+                enlarge_pipe(ffmpeg.stdin.fileno())
+                try:
+                    while next_write < len(segments):
+                        submit_segments()
+                        # Segments finish in any order, pipe each one as soon as everything before it is written
+                        finished, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in finished:
+                            done[futures.pop(future)] = future.result()
+                        # Every segment that is now contiguous with what was written goes out in one batch
+                        ready = []
+                        while next_write in done:
+                            ready.append(done.pop(next_write).getbuffer())
+                            next_write += 1
+                        if ready:
+                            try:
+                                write_buffers(ffmpeg.stdin.fileno(), ready)
+                            except BrokenPipeError as e:
+                                # ffmpeg quit before reading its input (bad output path, rejected subtitles, ...)
+                                ffmpeg.wait()
+                                raise subprocess.CalledProcessError(ffmpeg.returncode, cmd) from e
+                            del ready
+                            # Redraw at most every PROGRESS_INTERVAL seconds, and always for the last segment
+                            now = time.monotonic()
+                            if next_write == len(segments) or now - last_print >= PROGRESS_INTERVAL:
+                                last_print = now
+                                print_progress_bar(next_write, len(segments))
+                except BaseException:
+                    # A download failed, Ctrl+C or ffmpeg quit early (kill() is then a no-op);
+                    # stop ffmpeg, its partial output is removed below
+                    ffmpeg.kill()
+                    raise
+                print("\n[+] All segments downloaded.")
+                # Leaving the block closes stdin and waits for ffmpeg to finish the mux
+
+            if ffmpeg.returncode != 0:
+                raise subprocess.CalledProcessError(ffmpeg.returncode, cmd)
+            os.replace(tmp_output, output_file)
+            tmp_output = None
+        except BaseException:
+            # Drop the queued segments so leaving the executor only waits for the running downloads
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            # Also clean up when a download, ffmpeg or Ctrl+C aborts the run
+            if sub_file:
+                os.remove(sub_file)
+            if tmp_output and os.path.exists(tmp_output):
+                os.remove(tmp_output)
 
     print(f"[+] Done! Output saved as: {output_file}")
 
@@ -172,35 +336,11 @@ def get_user_input():
         m3u8_url = input("M3U8 URL: ").strip()
 
     # Erstelle eine temporäre Session und lade die Playlist um Auflösungen zu ermitteln
-    session = requests.Session()
-    session.headers.update({
-        "User-Agent": "Mozilla/5.0",
-        "Origin": "https://player.videasy.net",
-        "Referer": "https://player.videasy.net/"
-    })
+    session = create_session()
 
     print("\nFetching available video qualities...")
-    master_content = download_text(session, m3u8_url)
-
-    selected_playlist_url = m3u8_url  # default fallback
-
-    if is_master_playlist(master_content):
-        playlists = list_playlists(master_content, m3u8_url)
-        if not playlists:
-            print("[!] No playlists found in master playlist, using original URL.")
-        else:
-            print("\nAvailable video resolutions:")
-            for i, (res, _) in enumerate(playlists, 1):
-                print(f"  {i}. {res}")
-            while True:
-                choice = input(f"Select resolution [1-{len(playlists)}]: ").strip()
-                if choice.isdigit() and 1 <= int(choice) <= len(playlists):
-                    chosen_index = int(choice)
-                    selected_playlist_url = playlists[chosen_index - 1][1]
-                    break
-                print("Invalid input, please enter a valid number.")
-    else:
-        print("[+] No master playlist detected, using the provided URL.")
+    # Hand the playlist to main so it isn't downloaded (and the resolution asked for) twice
+    selected_playlist_url, segments, subtitle_urls = resolve_playlist(session, m3u8_url)
 
     print("\nEnter desired output filename (e.g. myvideo.mp4). If no extension is given, '.mp4' will be added:")
     output_file = input("Output filename: ").strip()
@@ -209,13 +349,13 @@ def get_user_input():
     elif '.' not in output_file:
         output_file += ".mp4"
 
-    return selected_playlist_url, output_file
+    return selected_playlist_url, segments, subtitle_urls, output_file
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         # No args, interactive mode
-        url, outfile = get_user_input()
-        main(url, outfile)
+        url, segments, subtitle_urls, outfile = get_user_input()
+        main(url, outfile, prefetched_segments=segments, prefetched_subtitle_urls=subtitle_urls)
     else:
         # Args given, use args but still ask for resolution interactively inside main
         m3u8_link = sys.argv[1]